@@ -1,29 +1,345 @@
 # ai_suggester.py
+import ast
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import streamlit as st  # <-- use Streamlit secrets
+from dotenv import load_dotenv
 from langchain_huggingface import ChatHuggingFace, HuggingFaceEndpoint
 from langchain_core.messages import HumanMessage
 
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
 # -------------------------
-# Read HuggingFace API token from Streamlit secrets
+# Model settings (also part of the response cache key)
 # -------------------------
-HF_TOKEN = st.secrets["HUGGINGFACEHUB_API_TOKEN"]
+REPO_ID = 'HuggingFaceH4/zephyr-7b-beta'
+TEMPERATURE = 0.3
+MAX_NEW_TOKENS = 800  # allow more tokens for AI Suggestions
+TOKEN_NAME = "HUGGINGFACEHUB_API_TOKEN"
+
+HTTP_TIMEOUT = 360  # seconds per endpoint request
+STREAM_RENDER_INTERVAL = 0.1  # seconds between partial renders while streaming
+PREFETCH_WORKERS = 2  # background threads shared by all sessions for cache warm-up
 
 # -------------------------
-# Setup HuggingFace LLM
+# Persistent cache (survives server restarts)
 # -------------------------
-llm = HuggingFaceEndpoint(
-    repo_id='HuggingFaceH4/zephyr-7b-beta',
-    huggingfacehub_api_token=HF_TOKEN,  # use the secret
-    temperature=0.3,
-    max_new_tokens=800  # allow more tokens for AI Suggestions
-)
+CACHE_DB_PATH = "cache.db"
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+def _resolve_token(token=None):
+    """Explicit token, then Streamlit secrets, then environment / .env"""
+    if token:
+        return token
+    try:
+        token = st.secrets.get(TOKEN_NAME)
+    except Exception:  # no secrets.toml configured
+        token = None
+    return token or os.getenv(TOKEN_NAME)
+
+@st.cache_resource(show_spinner=False)
+def _get_cache_db(path=CACHE_DB_PATH):
+    """One shared SQLite connection; WAL lets sessions read while another writes"""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache "
+        "(key TEXT PRIMARY KEY, response TEXT, ts INTEGER)"
+    )
+    # Expired rows are pruned on every store
+    conn.execute("CREATE INDEX IF NOT EXISTS cache_ts ON cache (ts)")
+    return conn
+
+def _normalize_code(code):
+    """Drop comments and formatting so only real code changes change the cache key"""
+    try:
+        return ast.unparse(ast.parse(code))
+    except SyntaxError:
+        return " ".join(code.split())
+
+def _to_result(text):
+    return {
+        "type": "AIResponse",
+        "message": text.strip(),
+        "severity": "Info"
+    }
+
+def _error_result(e):
+    return {
+        "type": "Error",
+        "message": f"❌ AI error: {str(e)}",
+        "severity": "Error"
+    }
+
+class AISuggester:
+    """
+    WHAT IT DOES: Sends prompts to the HuggingFace model and caches answers
+    """
+    def __init__(self, max_new_tokens=MAX_NEW_TOKENS, token=None):
+        self.max_new_tokens = max_new_tokens
+        llm = HuggingFaceEndpoint(
+            repo_id=REPO_ID,
+            huggingfacehub_api_token=_resolve_token(token),
+            temperature=TEMPERATURE,
+            max_new_tokens=max_new_tokens,
+            timeout=HTTP_TIMEOUT,
+            streaming=True
+        )
+        self.model = ChatHuggingFace(llm=llm)
+
+        # Requests in flight: cache key -> Future, so a second caller for the
+        # same prompt waits for the running call instead of sending it again
+        self._inflight: dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+
+    # ----- caching -----
+    def cache_key(self, prompt_text):
+        """SHA256 of the prompt together with the model settings"""
+        payload = {
+            "repo": REPO_ID,
+            "t": TEMPERATURE,
+            "mx": self.max_new_tokens,
+            "p": prompt_text,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def code_key(self, kind, code):
+        """
+        SHA256 of the prompt kind and the normalized code, so the same code
+        with different whitespace or comments reuses the earlier answer
+        """
+        payload = {
+            "repo": REPO_ID,
+            "t": TEMPERATURE,
+            "mx": self.max_new_tokens,
+            "kind": kind,
+            "code": _normalize_code(code),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    # The SQLite table is the only cache layer: a primary-key SELECT is
+    # sub-millisecond, and the TTL and pruning then apply to every hit
+    def _cache_get(self, key):
+        row = _get_cache_db().execute(
+            "SELECT response FROM cache WHERE key=? AND ts>?",
+            (key, int(time.time()) - CACHE_TTL_SECONDS),
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _cache_put(self, key, result):
+        now = int(time.time())
+        db = _get_cache_db()
+        db.execute(
+            "INSERT OR REPLACE INTO cache (key, response, ts) VALUES (?, ?, ?)",
+            (key, json.dumps(result), now),
+        )
+        db.execute("DELETE FROM cache WHERE ts<?", (now - CACHE_TTL_SECONDS,))
+
+    def _cache_lookup(self, prompt_text, code_match=None):
+        """
+        Check the cache by exact prompt, then (if code_match=(kind, code) is given)
+        by prompt kind + normalized code.
+        Returns (cached_response_or_None, key, code_key) so a miss
+        can be stored without hashing again.
+        """
+        key = self.cache_key(prompt_text)
+        code_key = self.code_key(*code_match) if code_match is not None else None
+        for k in (key, code_key):
+            if k is not None:
+                cached = self._cache_get(k)
+                if cached is not None:
+                    return cached, key, code_key
+        return None, key, code_key
+
+    def _cache_store(self, key, code_key, result):
+        self._cache_put(key, result)
+        if code_key is not None:
+            self._cache_put(code_key, result)
+
+    # A broken cache (locked or read-only cache.db)
+    # must never break the model call itself
+    def _try_cache_lookup(self, prompt_text, code_match):
+        try:
+            return self._cache_lookup(prompt_text, code_match)
+        except Exception:
+            logger.warning("AI response cache lookup failed", exc_info=True)
+            return None, None, None
+
+    def _try_cache_store(self, key, code_key, result):
+        if key is None:
+            return
+        try:
+            self._cache_store(key, code_key, result)
+        except Exception:
+            logger.warning("AI response cache store failed", exc_info=True)
+
+    # ----- in-flight requests -----
+    def _claim(self, key):
+        """Return (future, owner); only the owner calls the model, then _release()s"""
+        if key is None:
+            return None, True
+        with self._inflight_lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return fut, False
+            fut = self._inflight[key] = Future()
+            return fut, True
+
+    def _release(self, key, fut, result):
+        if fut is None:
+            return
+        with self._inflight_lock:
+            self._inflight.pop(key, None)
+        fut.set_result(result)
 
-model = ChatHuggingFace(llm=llm)
+    # ----- model calls -----
+    def _stream_text(self, prompt_text, on_chunk):
+        """
+        Stream the reply, calling on_chunk with the text received so far.
+        Each call re-sends the whole partial reply, so it runs at most every
+        STREAM_RENDER_INTERVAL seconds, plus once at the end.
+        """
+        acc = []
+        last_render = time.monotonic()
+        for chunk in self.model.stream([HumanMessage(content=prompt_text)]):
+            acc.append(chunk.content)
+            now = time.monotonic()
+            if now - last_render >= STREAM_RENDER_INTERVAL:
+                on_chunk("".join(acc))
+                last_render = now
+        text = "".join(acc)
+        on_chunk(text)
+        return text
+
+    def _invoke(self, prompt_text, on_chunk):
+        try:
+            if on_chunk is None:
+                response = self.model.invoke([HumanMessage(content=prompt_text)])
+                return _to_result(response.content)
+            return _to_result(self._stream_text(prompt_text, on_chunk))
+        except Exception as e:
+            return _error_result(e)
+
+    async def _ainvoke(self, prompt_text):
+        try:
+            response = await self.model.ainvoke([HumanMessage(content=prompt_text)])
+            return _to_result(response.content)
+        except Exception as e:
+            return _error_result(e)
+
+    def suggest(self, prompt_text, use_cache=False, on_chunk=None, code_match=None):
+        """
+        Returns AI response for a given prompt_text.
+
+        Sampling is not deterministic (temperature > 0), so reusing an
+        earlier answer for the same prompt is opt-in via use_cache.
+        With use_cache, a call for a prompt that is already in flight
+        (e.g. a prefetch) waits for that call instead of sending it again.
+        code_match=(kind, code) also reuses the answer given for the same
+        code under the same kind, ignoring whitespace and comments.
+        If on_chunk is given, the reply is streamed and on_chunk is called
+        with the partial text as tokens arrive.
+        """
+        key = code_key = None
+        if use_cache:
+            cached, key, code_key = self._try_cache_lookup(prompt_text, code_match)
+            if cached is not None:
+                return cached
+
+        fut, owner = self._claim(key)
+        if not owner:
+            try:
+                return dict(fut.result(timeout=HTTP_TIMEOUT))
+            except Exception as e:
+                return _error_result(e)
+
+        # Waiters must be released even if the run is interrupted mid-stream
+        result = _error_result(RuntimeError("AI request was interrupted"))
+        try:
+            result = self._invoke(prompt_text, on_chunk)
+            if use_cache and result["type"] == "AIResponse":
+                self._try_cache_store(key, code_key, result)
+        finally:
+            self._release(key, fut, result)
+        return result
+
+    async def asuggest(self, prompt_text, use_cache=False, code_match=None):
+        """Async version of suggest, for running several prompts at once"""
+        key = code_key = None
+        if use_cache:
+            cached, key, code_key = self._try_cache_lookup(prompt_text, code_match)
+            if cached is not None:
+                return cached
+
+        fut, owner = self._claim(key)
+        if not owner:
+            try:
+                return dict(await asyncio.wait_for(asyncio.wrap_future(fut), HTTP_TIMEOUT))
+            except Exception as e:
+                return _error_result(e)
+
+        result = _error_result(RuntimeError("AI request was interrupted"))
+        try:
+            result = await self._ainvoke(prompt_text)
+            if use_cache and result["type"] == "AIResponse":
+                self._try_cache_store(key, code_key, result)
+        finally:
+            self._release(key, fut, result)
+        return result
+
+    def suggest_batch(self, prompts):
+        """
+        Run several prompts through LangChain's Runnable.batch and return one
+        result per prompt. batch sends a separate invoke (HTTP request) per
+        prompt on a thread pool, so they run in parallel, not as one request.
+        Meant for variations of the same prompt, so the caches are not used.
+        """
+        responses = self.model.batch(
+            [[HumanMessage(content=p)] for p in prompts], return_exceptions=True
+        )
+        return [
+            _error_result(r) if isinstance(r, Exception) else _to_result(r.content)
+            for r in responses
+        ]
+
+    def suggest_concurrent(self, prompts, use_cache=False, code_matches=None):
+        """
+        Run independent prompts concurrently.
+        Total wait is the slowest call instead of the sum of all calls.
+        code_matches, if given, holds one code_match=(kind, code) per prompt.
+        """
+        code_matches = code_matches or [None] * len(prompts)
+
+        async def gather():
+            return await asyncio.gather(
+                *(self.asuggest(p, use_cache=use_cache, code_match=cm)
+                  for p, cm in zip(prompts, code_matches))
+            )
+        return asyncio.run(gather())
+
+@st.cache_resource(show_spinner=False)
+def _get_prefetch_executor():
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="ai-prefetch")
+
+@st.cache_resource(show_spinner=False)
+def get_suggester(max_new_tokens=MAX_NEW_TOKENS, token=None):
+    """One shared AISuggester (client + caches) per configuration"""
+    return AISuggester(max_new_tokens=max_new_tokens, token=token)
 
 # -------------------------
 # Function to get AI suggestions or answers
 # -------------------------
-def get_ai_suggestions(prompt_text, variation=0):
+def get_ai_suggestions(prompt_text, use_cache=False, on_chunk=None, code_match=None):
     """
     Returns AI response for a given prompt_text.
     Can be used for:
@@ -31,17 +347,45 @@ def get_ai_suggestions(prompt_text, variation=0):
     - Improved Code
     - AI Chat
     """
+    return get_suggester().suggest(prompt_text, use_cache=use_cache, on_chunk=on_chunk,
+                                   code_match=code_match)
+
+async def aget_ai_suggestions(prompt_text, use_cache=False, code_match=None):
+    """Async version of get_ai_suggestions"""
+    return await get_suggester().asuggest(prompt_text, use_cache=use_cache, code_match=code_match)
+
+def get_ai_suggestions_batch(prompts):
+    """Run several prompts in parallel via model.batch (see AISuggester.suggest_batch)"""
     try:
-        response = model.invoke([HumanMessage(content=prompt_text)])
-        ai_message = response.content.strip()
-        return {
-            "type": "AIResponse",
-            "message": ai_message,
-            "severity": "Info"
-        }
+        return get_suggester().suggest_batch(prompts)
     except Exception as e:
-        return {
-            "type": "Error",
-            "message": f"❌ AI error: {str(e)}",
-            "severity": "Error"
-        }
+        return [_error_result(e) for _ in prompts]
+
+def get_ai_suggestions_concurrent(prompts, use_cache=False, code_matches=None):
+    """Run independent prompts concurrently (see AISuggester.suggest_concurrent)"""
+    try:
+        return get_suggester().suggest_concurrent(prompts, use_cache=use_cache, code_matches=code_matches)
+    except Exception as e:
+        return [_error_result(e) for _ in prompts]
+
+def prefetch_ai_suggestions(prompts, code_matches=None):
+    """
+    Warm the response cache for prompts on the shared prefetch executor and
+    return immediately; later calls with the same prompts are then cache
+    hits, or wait for the prefetch if it is still running.
+    """
+    try:
+        # resolved here, on the script thread
+        suggester = get_suggester()
+        executor = _get_prefetch_executor()
+    except Exception:
+        logger.warning("AI prefetch skipped", exc_info=True)
+        return
+
+    def run():
+        try:
+            suggester.suggest_concurrent(prompts, use_cache=True, code_matches=code_matches)
+        except Exception:
+            logger.warning("AI prefetch failed", exc_info=True)
+
+    executor.submit(run)
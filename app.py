@@ -2,8 +2,14 @@ import streamlit as st
 from code_parser import parse_code
 from style_checker import show_style_corrected
 from error_detector import detect_errors
-from ai_suggester import get_ai_suggestions
+from ai_suggester import REPO_ID, get_ai_suggestions, get_ai_suggestions_batch, prefetch_ai_suggestions
+from transformers import AutoTokenizer
+import html
+import logging
 import re
+import time
+
+logger = logging.getLogger(__name__)
 
 # =========================
 # Page Config
@@ -17,26 +23,192 @@ st.set_page_config(
 # =========================
 # Helpers
 # =========================
+MORE_SUGGESTIONS = 3  # review variations fetched per "More Suggestions" click
+
+# Input size limits: code sent to the model is trimmed, chat history is capped
+MAX_CODE_CHARS = 8000
+MAX_CODE_TOKENS = 3000  # leaves room for instructions + 800 new tokens in a 4k window
+TRUNCATED_MARKER = "\n# [truncated]"
+TOKENIZER_RETRY_SECONDS = 300  # wait before retrying a failed tokenizer download
+HIST_MAX = 20
+
+# Static analysis is a pure function of the code string,
+# so reruns with the same code reuse the earlier result
+ANALYSIS_CACHE_ENTRIES = 64  # per cache, shared by all sessions
+
+@st.cache_data(max_entries=ANALYSIS_CACHE_ENTRIES, show_spinner=False)
+def _parse(c):
+    # Keep only what the handler reads; pickling the AST costs as much as re-parsing
+    result = parse_code(c)
+    return {"success": result["success"], "error": result.get("error")}
+
+@st.cache_data(max_entries=ANALYSIS_CACHE_ENTRIES, show_spinner=False)
+def _detect(c):
+    return detect_errors(c)
+
+@st.cache_data(max_entries=ANALYSIS_CACHE_ENTRIES, show_spinner=False)
+def _style(c):
+    return show_style_corrected(c)
+
 def reset_app():
     for key in list(st.session_state.keys()):
         del st.session_state[key]
     st.rerun()
 
+# Review section headers -> (emoji, color), styled in a single regex pass
+_HDR = re.compile(r'(Code Readability|Performance|Best Practices)\s*:')
+_STYLE = {
+    'Code Readability': ('🟢', '#16a34a'),
+    'Performance': ('🟡', '#ca8a04'),
+    'Best Practices': ('🔵', '#2563eb'),
+}
+
+def _style_header(match):
+    header = match.group(1)
+    emoji, color = _STYLE[header]
+    return f'<b style="color:{color};">{emoji} {header}:</b>'
+
 def format_ai_output(text):
     """Format AI output with colored headers for display"""
-    def style_header(match, emoji, color):
-        header = match.group(1)
-        return f'<b style="color:{color};">{emoji} {header}:</b>'
-    
-    text = re.sub(r'(Code Readability)\s*:', lambda m: style_header(m, '🟢', '#16a34a'), text)
-    text = re.sub(r'(Performance)\s*:', lambda m: style_header(m, '🟡', '#ca8a04'), text)
-    text = re.sub(r'(Best Practices)\s*:', lambda m: style_header(m, '🔵', '#2563eb'), text)
-    return text.replace("\n", "<br>")
+    return _HDR.sub(_style_header, text).replace("\n", "<br>")
+
+def stream_to(placeholder, box_class="answer-box", formatter=format_ai_output):
+    """Callback that renders partial AI output into placeholder while streaming"""
+    def render(text):
+        placeholder.markdown(f"<div class='{box_class}'>{formatter(text)}</div>", unsafe_allow_html=True)
+    return render
+
+# Prompts: the static instructions always come first and the code/question
+# last, so the shared prefix is byte-identical across calls and the
+# serving side can reuse its prompt (KV) cache. Keep these plain strings.
+REVIEW_PREFIX = """You are an expert Python developer.
+
+Task: Provide a concise review of this code, ONLY 2–3 lines per section.
+
+Include:
+- Code Readability
+- Performance
+- Best Practices
+- Time Complexity
+- Space Complexity
+
+Do NOT provide improved code."""
+
+IMPROVE_PREFIX = """You are an expert Python developer.
+
+Task: Return ONLY the improved working code. No explanations, no text."""
+
+COMPLEXITY_PREFIX = """You are an expert Python developer.
+
+Rules:
+1. Return ONLY Time Complexity and Space Complexity.
+2. No explanations, no code, no extra sections."""
+
+EXPLAIN_PREFIX = """You are an expert Python assistant.
+
+Rules:
+Explain clearly and fully. No extra sections."""
+
+CODE_PREFIX = """You are an expert Python developer.
+
+Rules:
+Return ONLY the requested code. No explanations, no extra text."""
+
+DEFAULT_PREFIX = """You are an expert Python assistant.
+
+Rules:
+Answer exactly what the user asks. No extra text, no Code Readability/Performance/Best Practices unless asked."""
+
+@st.cache_resource(show_spinner=False)
+def _load_tokenizer():
+    return AutoTokenizer.from_pretrained(REPO_ID)
+
+@st.cache_resource(show_spinner=False)
+def _tokenizer_state():
+    # Process-wide, so the backoff also holds across reruns and sessions
+    return {"failed_at": None}
+
+def _get_tokenizer():
+    """
+    Model tokenizer for token-exact trimming, or None if it can't be loaded.
+    cache_resource doesn't cache exceptions; after a failed download the
+    next attempt waits TOKENIZER_RETRY_SECONDS so prompts don't keep
+    stalling on an unreachable hub.
+    """
+    state = _tokenizer_state()
+    failed_at = state["failed_at"]
+    if failed_at is not None and time.monotonic() - failed_at < TOKENIZER_RETRY_SECONDS:
+        return None
+    try:
+        tokenizer = _load_tokenizer()
+    except Exception:
+        state["failed_at"] = time.monotonic()
+        logger.warning("Tokenizer unavailable, trimming code by characters only", exc_info=True)
+        return None
+    state["failed_at"] = None
+    return tokenizer
+
+def trim_code(code):
+    """
+    Cut code to MAX_CODE_CHARS, then to MAX_CODE_TOKENS, marking any cut.
+    The token-exact result is kept per session, so each analyzed code is tokenized once.
+    """
+    cached = st.session_state.get("trimmed_code")
+    if cached is not None and cached[0] == code:
+        return cached[1]
+
+    trimmed = code[:MAX_CODE_CHARS]
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        ids = tokenizer(trimmed, add_special_tokens=False)["input_ids"]
+        if len(ids) > MAX_CODE_TOKENS:
+            trimmed = tokenizer.decode(ids[:MAX_CODE_TOKENS])
+    if len(trimmed) < len(code):
+        trimmed += TRUNCATED_MARKER
+    if tokenizer is not None:
+        st.session_state.trimmed_code = (code, trimmed)
+    return trimmed
+
+# Chat question router: one compiled regex instead of a chain of substring checks.
+# Each lookahead scans the whole question, and alternatives are tried in order,
+# so a complexity keyword still wins over "explain", and "explain" over "code".
+_ROUTER = re.compile(
+    r'^(?:(?=.*?(?P<cx>time|space|complexity))'
+    r'|(?=.*?(?P<ex>explain|why))'
+    r'|(?=.*?(?P<cd>code|implement|write)))',
+    re.IGNORECASE | re.DOTALL,
+)
+PROMPTS = {
+    "cx": COMPLEXITY_PREFIX,
+    "ex": EXPLAIN_PREFIX,
+    "cd": CODE_PREFIX,
+    "default": DEFAULT_PREFIX,
+}
+
+def route_question(question):
+    """Return the PROMPTS key for a chat question"""
+    m = _ROUTER.match(question)
+    if m is None:
+        return "default"
+    return next(k for k, v in m.groupdict().items() if v)
+
+def review_prompt(code):
+    """Prompt for the AI Suggestions button"""
+    return REVIEW_PREFIX + "\n\nCode:\n" + trim_code(code)
+
+def improve_prompt(code):
+    """Prompt for the Improved Code button"""
+    return IMPROVE_PREFIX + "\n\nCode:\n" + trim_code(code)
+
+def chat_prompt(prefix, code, question):
+    """Prompt for the AI Chat, with the user's question after the code"""
+    return prefix + "\n\nCode:\n" + trim_code(code) + "\n\nUser Question:\n" + question
 
 # =========================
-# CSS
+# Static HTML: global CSS + sidebar features box,
+# sent to the frontend in a single st.markdown call
 # =========================
-st.markdown("""
+_STATIC_HTML = """
 <style>
 .stApp {background: linear-gradient(to right, #f0fdf4, #ecfeff);}
 [data-baseweb="button"] {background-color: #16a34a !important; color: white !important; border-radius: 12px !important; font-weight: bold !important; padding: 10px 16px !important; transition: all 0.2s ease-in-out;}
@@ -44,7 +216,16 @@ st.markdown("""
 .code-box {background:#0f172a; color:#e5e7eb; padding:16px; border-radius:12px; font-family: monospace; font-size:15px; font-weight:bold; overflow-x:auto;}
 .answer-box {background:#f0fdf4; padding:18px; border-radius:16px; border-left:6px solid #22c55e; font-size:16px;}
 </style>
-""", unsafe_allow_html=True)
+<div style="background-color:rgba(34,197,94,0.15); padding:14px; border-radius:14px; border:1px solid #22c55e;">
+    <b>✔ Features</b>
+    <ul>
+        <li>Syntax Validation</li>
+        <li>Error Detection</li>
+        <li>PEP8 Formatting</li>
+        <li>AI Review + Improvement</li>
+    </ul>
+</div>
+"""
 
 # =========================
 # Session State
@@ -62,21 +243,16 @@ for key, default in {
 # Sidebar
 # =========================
 with st.sidebar:
-    st.markdown("## 🧠 AI Code Reviewer")
-    st.markdown("#### Smart Python Analysis Tool")
+    st.markdown("## 🧠 AI Code Reviewer\n#### Smart Python Analysis Tool")
     st.divider()
-    st.markdown("""
-    <div style="background-color:rgba(34,197,94,0.15); padding:14px; border-radius:14px; border:1px solid #22c55e;">
-        <b>✔ Features</b>
-        <ul>
-            <li>Syntax Validation</li>
-            <li>Error Detection</li>
-            <li>PEP8 Formatting</li>
-            <li>AI Review + Improvement</li>
-        </ul>
-    </div>
-    """, unsafe_allow_html=True)
+    # Styles are global, so emitting them inside the sidebar still applies app-wide
+    st.markdown(_STATIC_HTML, unsafe_allow_html=True)
     st.divider()
+    st.toggle(
+        "Prepare AI answers on Analyze",
+        key="prefetch_ai",
+        help="Request the AI review and improved code in the background while you read the analysis. Uses two AI calls per Analyze.",
+    )
     st.button("🔄 Reset Application", use_container_width=True, on_click=reset_app)
 
 # =========================
@@ -104,7 +280,7 @@ code = st.text_area(
 # =========================
 # Buttons
 # =========================
-col_analysis, col_ai_sugg, col_improved = st.columns([2,2,2])
+col_analysis, col_ai_sugg, col_more, col_improved = st.columns([2,2,2,2])
 
 # ----- Analyze Code -----
 with col_analysis:
@@ -118,14 +294,14 @@ with col_analysis:
         st.session_state.ai_call_count = 0
 
         # Parse
-        result = parse_code(code)
+        result = _parse(code)
         if not result["success"]:
             st.error(result["error"]["message"])
             st.stop()
         st.success("✅ Code parsed successfully")
 
         # Errors
-        err = detect_errors(code)
+        err = _detect(code)
         if err["error_count"] > 0:
             for e in err["errors"]:
                 st.error(e["message"])
@@ -134,13 +310,21 @@ with col_analysis:
 
         # Formatting
         try:
-            style = show_style_corrected(code)
+            style = _style(code)
             if style["success"]:
                 with st.expander("Formatted Code"):
                     st.code(style["corrected_code"], language="python")
         except:
             pass
 
+        # Opt-in: warm the AI cache in the background. Review and improved code
+        # are independent, so both are requested at once without holding up the page
+        if st.session_state.prefetch_ai:
+            prefetch_ai_suggestions(
+                [review_prompt(code), improve_prompt(code)],
+                code_matches=[("review", code), ("improve", code)]
+            )
+
 # ----- AI Suggestions -----
 with col_ai_sugg:
     if st.button("🤖 AI Suggestions", use_container_width=True):
@@ -148,27 +332,34 @@ with col_ai_sugg:
             st.info("Analyze code first.")
         else:
             with st.spinner("Generating suggestion..."):
-                prompt = f"""
-You are an expert Python developer.
-
-Task: Provide a concise review of this code, ONLY 2–3 lines per section.
-
-Include:
-- Code Readability
-- Performance
-- Best Practices
-- Time Complexity
-- Space Complexity
-
-Do NOT provide improved code.
-
-Code:
-{st.session_state.analyzed_code}
-"""
-                s = get_ai_suggestions(prompt, st.session_state.ai_call_count)
+                prompt = review_prompt(st.session_state.analyzed_code)
+                placeholder = st.empty()
+                s = get_ai_suggestions(prompt, use_cache=True,
+                                       on_chunk=stream_to(placeholder),
+                                       code_match=("review", st.session_state.analyzed_code))
+                placeholder.empty()
                 s["message"] = format_ai_output(s["message"])
-                st.session_state.ai_suggestions.append(s)
-                st.session_state.ai_call_count += 1
+                # A re-click on the same code is a cache hit: don't list it twice
+                if any(prev["message"] == s["message"] for prev in st.session_state.ai_suggestions):
+                    st.info("This review is already shown below.")
+                else:
+                    st.session_state.ai_suggestions.append(s)
+                    st.session_state.ai_call_count += 1
+
+# ----- More Suggestions -----
+with col_more:
+    if st.button("🔁 More Suggestions", use_container_width=True):
+        if not st.session_state.analyzed_code:
+            st.info("Analyze code first.")
+        else:
+            with st.spinner("Generating more suggestions..."):
+                prompt = review_prompt(st.session_state.analyzed_code)
+                # All variations in parallel (one request each), rendered in this same run
+                for s in get_ai_suggestions_batch([prompt] * MORE_SUGGESTIONS):
+                    if s["type"] == "AIResponse":
+                        st.session_state.ai_call_count += 1
+                    s["message"] = format_ai_output(s["message"])
+                    st.session_state.ai_suggestions.append(s)
 
 # Display AI suggestions
 st.divider()
@@ -183,96 +374,51 @@ with col_improved:
             st.info("Analyze code first.")
         else:
             with st.spinner("Generating improved code..."):
-                prompt = f"""
-You are an expert Python developer.
-
-Task: Return ONLY the improved working code. No explanations, no text.
-
-Original Code:
-{st.session_state.analyzed_code}
-"""
-                code_res = get_ai_suggestions(prompt, st.session_state.ai_call_count)
+                prompt = improve_prompt(st.session_state.analyzed_code)
+                placeholder = st.empty()
+                code_res = get_ai_suggestions(prompt, use_cache=True,
+                                              on_chunk=stream_to(placeholder, "code-box", str),
+                                              code_match=("improve", st.session_state.analyzed_code))
                 st.session_state.ai_call_count += 1
-                st.markdown(f"<div class='code-box'>{code_res['message']}</div>", unsafe_allow_html=True)
+                placeholder.markdown(f"<div class='code-box'>{code_res['message']}</div>", unsafe_allow_html=True)
 
 # =========================
 # AI Chat Section
 # =========================
-st.divider()
-st.markdown("### 💬 AI Chat")
-question = st.text_input("Type your question here")
-
-if st.button("Ask AI"):
-    if not st.session_state.analyzed_code:
-        st.warning("Analyze code first!")
-        st.stop()
-
-    q = question.lower()
-    if "time" in q or "space" in q or "complexity" in q:
-        prompt = f"""
-You are an expert Python developer.
-
-Code:
-{st.session_state.analyzed_code}
-
-User Question:
-{question}
-
-Rules:
-1. Return ONLY Time Complexity and Space Complexity.
-2. No explanations, no code, no extra sections.
-"""
-    elif "explain" in q or "why" in q:
-        prompt = f"""
-You are an expert Python assistant.
-
-Code:
-{st.session_state.analyzed_code}
-
-User Question:
-{question}
-
-Rules:
-Explain clearly and fully. No extra sections.
-"""
-    elif "code" in q or "implement" in q or "write" in q:
-        prompt = f"""
-You are an expert Python developer.
-
-Code:
-{st.session_state.analyzed_code}
-
-User Question:
-{question}
-
-Rules:
-Return ONLY the requested code. No explanations, no extra text.
-"""
-    else:
-        prompt = f"""
-You are an expert Python assistant.
-
-Code:
-{st.session_state.analyzed_code}
-
-User Question:
-{question}
-
-Rules:
-Answer exactly what the user asks. No extra text, no Code Readability/Performance/Best Practices unless asked.
-"""
+def ask_ai(question):
+    """Route the question to a prompt and store the AI answer in chat history"""
+    prefix = PROMPTS[route_question(question)]
+    prompt = chat_prompt(prefix, st.session_state.analyzed_code, question)
 
     with st.spinner("AI thinking..."):
-        r = get_ai_suggestions(prompt, st.session_state.ai_call_count)
-        r["message"] = format_ai_output(r["message"])
-        st.session_state.chat_history.append({"question": question, "answer": r["message"]})
+        placeholder = st.empty()
+        r = get_ai_suggestions(prompt, use_cache=True,
+                               on_chunk=stream_to(placeholder))
+        placeholder.empty()
+        ans = format_ai_output(r["message"])
+        box = "code-box" if "```" in ans or "def " in ans else "answer-box"
+        # Build the HTML once here; reruns only join the stored strings
+        html_entry = f"<p><b>❓ {html.escape(question)}</b></p><div class='{box}'>{ans}</div>"
+        st.session_state.chat_history.append({"question": question, "answer": ans, "html": html_entry})
+        st.session_state.chat_history = st.session_state.chat_history[-HIST_MAX:]
         st.session_state.ai_call_count += 1
 
-# Display last AI answer
-if st.session_state.chat_history:
-    ans = st.session_state.chat_history[-1]["answer"]
-    if "```" in ans or "def " in ans:
-        st.markdown(f"<div class='code-box'>{ans}</div>", unsafe_allow_html=True)
-    else:
-        st.markdown(f"<div class='answer-box'>{ans}</div>", unsafe_allow_html=True)
+# Only this block reruns when the user asks a question,
+# not the header, sidebar and analysis sections above
+@st.fragment
+def chat_panel():
+    st.markdown("### 💬 AI Chat")
+    question = st.text_input("Type your question here")
+
+    if st.button("Ask AI"):
+        if not st.session_state.analyzed_code:
+            st.warning("Analyze code first!")
+            return
+        ask_ai(question)
 
+    # Display chat history in a single markdown element
+    if st.session_state.chat_history:
+        st.markdown("".join(c["html"] for c in st.session_state.chat_history), unsafe_allow_html=True)
+
+st.divider()
+chat_panel()